@@ -1,16 +1,53 @@
 import os
+import shutil
+import tempfile
+import atexit
+import queue
+import threading
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 from flask import Flask, request, jsonify, render_template, send_from_directory, flash, redirect, url_for
 # from flask_wtf.csrf import CSRFProtect
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
+from werkzeug.exceptions import ClientDisconnected
 from os.path import basename
 from clases import ProyectoAudio, Cancion, Pista
-from procesamiento_audio import separate_stems, mix_tracks, generate_stem_variation
+from procesamiento_audio import (
+    separate_stems, mix_tracks, generate_stem_variation,
+    stream_to_disk_and_hash, validate_stems_integrity, find_cached_stems,
+    DEMUCS_BACKEND,
+)
 import time
+import uuid
 
 # -------------------------------------------------------
 # -------------------------------------------------------
 load_dotenv()
+
+# Logging en lugar de print: con varios hilos no se compite por stdout
+# y los mensajes DEBUG no cuestan nada si el nivel es INFO o superior.
+# Las peticiones solo encolan el registro; un hilo aparte lo escribe en stderr.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# QueueHandler.prepare() deja el mensaje ya formateado en el registro: con solo
+# "%(message)s" aquí, el formato con hora y nivel lo aplica una vez el listener
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[_queue_handler],
+)
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "dev_key_fallback")
 # csrf = CSRFProtect(app)
@@ -24,31 +61,36 @@ app.config["OUTPUT_FOLDER"] = OUTPUT_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Pools acotados para los trabajos pesados: las separaciones y las mezclas
+# corren en hilos propios y la petición HTTP no queda bloqueada.
+# Con el backend en proceso hay un solo modelo Demucs y su inferencia va de a
+# una (procesamiento_audio._demucs_lock): con dos hilos, uno decodifica o
+# escribe stems mientras el otro separa. Con el CLI cada separación es un
+# subproceso, así que se limitan a la mitad de los núcleos.
+SEPARATION_POOL = ThreadPoolExecutor(
+    max_workers=2 if DEMUCS_BACKEND != "cli" else max(1, (os.cpu_count() or 2) // 2),
+    thread_name_prefix="separacion",
+)
+MIX_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mezcla")
+
 # Proyecto principal de audio
 proyecto = ProyectoAudio("Proyecto de Audio")
 try:
     proyecto.cargar_estado()
 except ValueError:
-    print("No se encontró estado previo, iniciando proyecto vacío.")
+    log.info("No se encontró estado previo, iniciando proyecto vacío.")
 except Exception as e:
-    print(f"Error al cargar estado: {e}")
+    log.error("Error al cargar estado: %s", e)
 
 # Verificar que FFmpeg esté disponible (requerido por Demucs)
+# Se busca en el PATH una sola vez (sin lanzar un proceso) y se guarda la ruta.
+FFMPEG_PATH = shutil.which("ffmpeg")
+
 def check_ffmpeg():
     """Verifica que FFmpeg esté instalado y disponible"""
-    import subprocess
-    try:
-        result = subprocess.run(
-            ["ffmpeg", "-version"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=5
-        )
-        if result.returncode == 0:
-            print("✅ FFmpeg detectado correctamente")
-            return True
-    except (FileNotFoundError, subprocess.TimeoutExpired):
-        pass
+    if FFMPEG_PATH:
+        print(f"✅ FFmpeg detectado correctamente: {FFMPEG_PATH}")
+        return True
     
     print("=" * 60)
     print("⚠️  ADVERTENCIA: FFmpeg no está instalado")
@@ -74,29 +116,79 @@ def index():
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    """Sube un archivo musical y lo registra en el proyecto."""
+    """
+    Sube un archivo musical y lo registra en el proyecto.
+    Acepta el cuerpo crudo (application/octet-stream + cabecera X-Filename),
+    que se escribe directo a disco, o multipart/form-data como alternativa.
+    """
     try:
-        if "file" not in request.files:
+        if request.mimetype == "application/octet-stream":
+            filename = secure_filename(unquote(request.headers.get("X-Filename", "")))
+        elif "file" not in request.files:
             return jsonify({"error": "No se envió ningún archivo"}), 400
-
-        file = request.files["file"]
-        if file.filename == "":
+        else:
+            filename = secure_filename(request.files["file"].filename)
+        if not filename:
             return jsonify({"error": "Nombre de archivo inválido"}), 400
 
-        filename = secure_filename(file.filename)
+        # La subida se escribe en un temporal y solo pasa a uploads/<filename> si
+        # llegó completa y no es un duplicado: el archivo que ya tenga ese nombre
+        # (y que puede usar otra canción) no se toca hasta entonces
         filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(filepath)
-
-        print(f"📁 Archivo guardado: {filepath}")
+        fd, tmp_path = tempfile.mkstemp(dir=app.config["UPLOAD_FOLDER"], prefix=".upload-")
+        os.close(fd)
+        try:
+            if request.mimetype == "application/octet-stream":
+                # Escritura y hash en una sola pasada sobre los datos
+                try:
+                    _, file_hash = stream_to_disk_and_hash(request.stream, tmp_path)
+                    completa = (request.content_length is None
+                                or os.path.getsize(tmp_path) == request.content_length)
+                except ClientDisconnected:
+                    completa = False
+                if not completa:
+                    os.remove(tmp_path)
+                    return jsonify({"error": "Subida incompleta"}), 400
+            else:
+                request.files["file"].save(tmp_path)
+                file_hash = None
+
+            # Reconocer archivos idénticos ya subidos (aunque tengan otro nombre).
+            # Solo se calcula el hash si hay canciones del mismo tamaño.
+            existente, file_hash = proyecto.encontrar_duplicado(tmp_path, file_hash)
+            if existente and os.path.exists(existente.archivo_ruta):
+                os.remove(tmp_path)
+                log.info("♻️ Archivo reconocido: %s", existente.titulo)
+                return jsonify({
+                    "success": True,
+                    "filename": basename(existente.archivo_ruta),
+                    "reconocido": True,
+                    "mensaje": "Archivo ya existente en el proyecto"
+                })
+
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        log.info("📁 Archivo guardado: %s", filepath)
 
         # Crear objeto Cancion
         nueva_cancion = Cancion(filename, filepath, "audio")
+        nueva_cancion.hash_archivo = file_hash
+
+        # Si ese contenido ya se separó antes (con cualquier nombre), sus stems
+        # se asocian ya: /separar será una simple consulta
+        if file_hash:
+            for name, path in find_cached_stems(app.config["OUTPUT_FOLDER"], file_hash).items():
+                nueva_cancion.agregar_pista(Pista(name, path))
 
         # Añadir al proyecto
         proyecto.agregar_cancion(nueva_cancion)
         proyecto.guardar_estado()
 
-        print(f"Canción registrada: {filename}")
+        log.info("Canción registrada: %s", filename)
 
         return jsonify({
             "success": True,
@@ -105,21 +197,22 @@ def upload_file():
         })
 
     except Exception as e:
-        print(f"Error al subir archivo: {str(e)}")
+        log.error("Error al subir archivo: %s", e)
         return jsonify({"error": f"Error al subir archivo: {str(e)}"}), 500
 
 
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
     """Sirve archivos subidos"""
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    # conditional=True: ETag/If-Modified-Since y Range (206) para poder hacer seek
+    return send_from_directory(app.config["UPLOAD_FOLDER"], filename, conditional=True)
 
 
 @app.route("/proyecto")
 def proyecto_view():
     """Muestra la vista del proyecto con la canción seleccionada"""
     nombre_archivo = request.args.get("archivo")
-    print(f"🔍 Buscando canción: {nombre_archivo}")
+    log.debug("🔍 Buscando canción: %s", nombre_archivo)
 
     # Buscar canción en el proyecto
     cancion = proyecto.encontrar_cancion_por_archivo(nombre_archivo)
@@ -128,7 +221,7 @@ def proyecto_view():
         flash("Canción no encontrada")
         return redirect(url_for("upload_file"))
 
-    print(f"Canción encontrada: {cancion.titulo}")
+    log.debug("Canción encontrada: %s", cancion.titulo)
 
     return render_template(
         "proyectos.html",
@@ -142,12 +235,12 @@ def separar():
     """
     Separa una canción en stems usando Demucs.
     """
-    print("Endpoint /separar llamado")
+    log.debug("Endpoint /separar llamado")
 
     data = request.get_json()
     nombre_archivo = data.get("nombre")
 
-    print(f"Data recibida: {data}")
+    log.debug("Data recibida: %s", data)
 
     if not nombre_archivo:
         return jsonify({"error": "Falta el nombre del archivo"}), 400
@@ -159,12 +252,12 @@ def separar():
 
     # Verificar que el archivo existe
     if not os.path.exists(ruta_archivo):
-        print(f"Archivo no encontrado: {ruta_archivo}")
+        log.warning("Archivo no encontrado: %s", ruta_archivo)
         return jsonify({"error": f"Archivo no encontrado: {nombre_archivo}"}), 404
 
     # Verificar que el archivo NO esté vacío (esta era una causa frecuente)
     size = os.path.getsize(ruta_archivo)
-    print(f"Tamaño del archivo original: {size} bytes")
+    log.debug("Tamaño del archivo original: %d bytes", size)
 
     if size == 0:
         return jsonify({"error": "El archivo subido está vacío"}), 400
@@ -172,65 +265,68 @@ def separar():
     # Localizar la Cancion en el proyecto
     cancion = proyecto.encontrar_cancion_por_archivo(nombre_archivo)
     if not cancion:
-        print(f"Canción no registrada: {nombre_archivo}")
+        log.warning("Canción no registrada: %s", nombre_archivo)
         return jsonify({"error": "Canción no registrada en el proyecto"}), 404
 
+    # Si ya se separó antes y los stems siguen en disco, no se vuelve a ejecutar Demucs
+    with proyecto.lock:
+        pistas_cache = cancion.stems_en_cache()
+    if pistas_cache:
+        log.info("♻️ Stems recuperados de caché: %s", nombre_archivo)
+        return jsonify({
+            "mensaje": "Separación recuperada de caché",
+            "pistas": {name: pista.url for name, pista in pistas_cache.items()}
+        })
+
+    # La separación tarda minutos: se encola y se responde 202 con un job_id.
+    # Si esta canción ya se está separando, se devuelve el job_id de ese trabajo
+    # (el hash del audio se calcula ya dentro del trabajo, no en la petición)
+    return _enviar_trabajo(
+        SEPARATION_POOL, _separar_cancion, cancion, ruta_archivo,
+        clave=("separar", id(cancion)),
+    )
+
+
+def _separar_cancion(cancion, ruta_archivo):
+    """Trabajo de /separar: ejecuta Demucs y registra las pistas en el proyecto."""
     try:
-        print(f"Iniciando separación de stems...")
-        print(f"Archivo: {ruta_archivo}")
-        print(f"Output: {app.config['OUTPUT_FOLDER']}")
+        log.info("Iniciando separación de stems: %s", ruta_archivo)
+        log.debug("Output: %s", app.config["OUTPUT_FOLDER"])
 
-        # FORZAMOS EJECUCIÓN SÍNCRONA Y BLOQUEANTE
-        stems = separate_stems(ruta_archivo, app.config["OUTPUT_FOLDER"])
+        # Los stems se guardan por contenido (outputs_remix/stems/<hash>/):
+        # el mismo audio subido con otro nombre no vuelve a pasar por Demucs
+        file_hash = proyecto.asegurar_hash(cancion)
+        stems = separate_stems(ruta_archivo, app.config["OUTPUT_FOLDER"], file_hash)
 
         # VALIDACIÓN CLAVE: asegurarse de que los stems existen y NO están vacíos
-        stems_validos = {}
-        for name, path in stems.items():
-            if os.path.exists(path) and os.path.getsize(path) > 1000:
-                stems_validos[name] = path
-                print(f"Pista válida: {name} ({os.path.getsize(path)} bytes)")
-            else:
-                print(f" Pista inválida o vacía: {name} ({os.path.getsize(path) if os.path.exists(path) else 0} bytes)")
+        stems_validos = validate_stems_integrity(stems)
+        for name in stems.keys() - stems_validos.keys():
+            log.warning("Pista inválida o vacía: %s", name)
 
         if not stems_validos:
-            return jsonify({
-                "error": "La separación se ejecutó pero todos los stems están vacíos",
-                "detalle": "Revisa separate_stems(): no está esperando a que Demucs escriba."
-            }), 500
+            raise RuntimeError("La separación se ejecutó pero todos los stems están vacíos")
 
         # Añadir cada pista válida al proyecto
-        for name, path in stems_validos.items():
-            pista = Pista(name, path)
-            cancion.agregar_pista(pista)
-            print(f"Pista añadida al proyecto: {name}")
-
-        proyecto.guardar_estado()
-
-        # Convertimos las rutas REALES a rutas PÚBLICAS correctas
+        # (cada Pista ya trae su ruta PÚBLICA calculada en pista.url)
         pistas_publicas = {}
-        for name, path in stems_validos.items():
-            # Obtenemos el path relativo desde la carpeta de outputs
-            # Ejemplo: htdemucs/cancion/vocals.wav
-            rel_path = os.path.relpath(path, app.config["OUTPUT_FOLDER"])
-            
-            # Aseguramos slashs para URL (Windows usa backslash)
-            rel_path_url = rel_path.replace(os.sep, '/')
-            
-            pistas_publicas[name] = f"outputs_remix/{rel_path_url}"
+        with proyecto.lock:
+            for name, path in stems_validos.items():
+                pista = Pista(name, path)
+                cancion.agregar_pista(pista)
+                pistas_publicas[name] = pista.url
+                log.debug("Pista añadida al proyecto: %s", name)
 
-        return jsonify({
+            cancion.marcar_stems_verificados()
+            proyecto.guardar_estado()
+
+        return {
             "mensaje": "Separación completada exitosamente",
             "pistas": pistas_publicas
-        })
+        }
 
-    except Exception as e:
-        import traceback
-        print(f"ERROR DURANTE LA SEPARACIÓN:")
-        print(traceback.format_exc())
-        return jsonify({
-            "error": f"Error durante la separación: {str(e)}",
-            "detalle": traceback.format_exc()
-        }), 500
+    except Exception:
+        log.exception("ERROR DURANTE LA SEPARACIÓN")
+        raise
 
 
 
@@ -239,7 +335,7 @@ def mezclar():
     """
     Mezcla pistas (stems) seleccionadas.
     """
-    print("Endpoint /mezclar llamado")
+    log.debug("Endpoint /mezclar llamado")
 
     data = request.get_json()
     pistas = data.get("pistas")
@@ -247,34 +343,120 @@ def mezclar():
     if not pistas or not isinstance(pistas, (list, tuple)):
         return jsonify({"error": "No se proporcionaron pistas en formato lista"}), 400
 
+    # Las pistas llegan como URLs públicas ("outputs_remix/htdemucs/...")
+    rutas_pistas = []
+    for pista in pistas:
+        rel_path = pista.split("outputs_remix/", 1)[-1]
+        ruta = safe_join(app.config["OUTPUT_FOLDER"], rel_path)
+        if ruta is None or not os.path.exists(ruta):
+            return jsonify({"error": f"Pista no encontrada: {pista}"}), 404
+        rutas_pistas.append(ruta)
+
+    ruta_salida = os.path.join(app.config["OUTPUT_FOLDER"], f"mix_{uuid.uuid4().hex}.wav")
+
+    return _enviar_trabajo(MIX_POOL, _mezclar_pistas, rutas_pistas, ruta_salida)
+
+
+def _mezclar_pistas(rutas_pistas, ruta_salida):
+    """Trabajo de /mezclar."""
     try:
-        print(f"   Iniciando mezcla de {len(rutas_pistas)} pistas...")
-        
-        # Llamada SÍNCRONA
+        log.info("Iniciando mezcla de %d pistas...", len(rutas_pistas))
         mix_tracks(rutas_pistas, ruta_salida)
+        log.info("Mezcla completada: %s", ruta_salida)
 
-        print(f"Mezcla completada: {ruta_salida}")
-
-        return jsonify({
+        return {
             "mensaje": "Mezcla completada exitosamente",
             "archivo_resultante": basename(ruta_salida)
-        })
+        }
 
-    except Exception as e:
+    except Exception:
+        log.exception("ERROR DURANTE LA MEZCLA")
+        raise
+
+
+# -------------------------------------------------------
+# Trabajos en segundo plano
+# -------------------------------------------------------
+
+# job_id -> Future. Los terminados se conservan TRABAJO_TTL_SEG segundos para
+# que el cliente (o varios, si comparten trabajo) recojan el resultado; después
+# se descartan aunque nadie los haya consultado.
+TRABAJOS = {}
+TRABAJO_TTL_SEG = int(os.getenv("TRABAJO_TTL_SEG", "3600"))
+# job_id -> instante (time.monotonic) en que terminó
+_TRABAJOS_TERMINADOS = {}
+# clave (la canción en /separar) -> job_id del trabajo en curso
+_TRABAJOS_EN_CURSO = {}
+# RLock: add_done_callback llama al callback en el acto si el trabajo ya terminó
+_trabajos_lock = threading.RLock()
+
+
+def _purgar_trabajos():
+    """Descarta los trabajos que terminaron hace más de TRABAJO_TTL_SEG."""
+    limite = time.monotonic() - TRABAJO_TTL_SEG
+    with _trabajos_lock:
+        for job_id, fin in list(_TRABAJOS_TERMINADOS.items()):
+            if fin < limite:
+                del _TRABAJOS_TERMINADOS[job_id]
+                TRABAJOS.pop(job_id, None)
+
+
+def _trabajo_terminado(job_id, clave):
+    with _trabajos_lock:
+        _TRABAJOS_TERMINADOS[job_id] = time.monotonic()
+        if clave is not None and _TRABAJOS_EN_CURSO.get(clave) == job_id:
+            del _TRABAJOS_EN_CURSO[clave]
+
+
+def _enviar_trabajo(pool, fn, *args, clave=None):
+    """Encola fn(*args) en el pool y responde 202 con el id para consultarlo.
+    Si ya hay un trabajo en curso con la misma clave, se devuelve su id en
+    lugar de encolar otro."""
+    _purgar_trabajos()
+    with _trabajos_lock:
+        job_id = _TRABAJOS_EN_CURSO.get(clave) if clave is not None else None
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+            future = pool.submit(fn, *args)
+            TRABAJOS[job_id] = future
+            if clave is not None:
+                _TRABAJOS_EN_CURSO[clave] = job_id
+            future.add_done_callback(lambda _f: _trabajo_terminado(job_id, clave))
+    return jsonify({"job_id": job_id, "estado": "en_proceso"}), 202
+
+
+@app.route("/trabajos/<job_id>")
+def estado_trabajo(job_id):
+    """Estado de un trabajo: 202 mientras corre, 200 con el resultado o 500 si falló."""
+    _purgar_trabajos()
+    future = TRABAJOS.get(job_id)
+    if future is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+
+    if not future.done():
+        return jsonify({"job_id": job_id, "estado": "en_proceso"}), 202
+
+    error = future.exception()
+    if error is not None:
         import traceback
-        print(f"ERROR DURANTE LA MEZCLA:")
-        print(traceback.format_exc())
         return jsonify({
-            "error": f"Error durante la mezcla: {str(e)}",
-            "detalle": traceback.format_exc()
+            "error": f"Error durante el procesamiento: {str(error)}",
+            "detalle": "".join(traceback.format_exception(type(error), error, error.__traceback__))
         }), 500
 
+    return jsonify(future.result())
+
 
 @app.route("/outputs_remix/<path:filename>")
 def resultados(filename):
     """Sirve los archivos generados (stems o mezclas)."""
     try:
-        return send_from_directory(app.config["OUTPUT_FOLDER"], filename)
+        response = send_from_directory(app.config["OUTPUT_FOLDER"], filename, conditional=True)
+        # stems/<hash>/ depende solo del contenido: nunca cambia, el navegador
+        # puede guardarlo indefinidamente sin volver a preguntar
+        if filename.startswith("stems/"):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
     except FileNotFoundError:
         return jsonify({"error": "Archivo no encontrado"}), 404
 
@@ -284,7 +466,7 @@ def generate():
     """
     Genera un nuevo stem usando AI basado en el stem original y estilos seleccionados.
     """
-    print("Endpoint /generate llamado")
+    log.debug("Endpoint /generate llamado")
     
     data = request.get_json()
     stem = data.get("stem")
@@ -294,8 +476,8 @@ def generate():
         return jsonify({"error": "Faltan datos: stem o estilos"}), 400
     
     try:
-        print(f"🎨 Generando stem con estilos: {', '.join(styles)}")
-        print(f"📁 Stem base: {stem['name']}")
+        log.info("🎨 Generando stem con estilos: %s", ", ".join(styles))
+        log.debug("📁 Stem base: %s", stem["name"])
         
         # Generar nombre único
         timestamp = int(time.time())
@@ -325,8 +507,7 @@ def generate():
         
     except Exception as e:
         import traceback
-        print(f"ERROR DURANTE LA GENERACIÓN:")
-        print(traceback.format_exc())
+        log.exception("ERROR DURANTE LA GENERACIÓN")
         return jsonify({
             "error": f"Error durante la generación: {str(e)}",
             "detalle": traceback.format_exc()
@@ -345,5 +526,18 @@ if __name__ == "__main__":
     print(f"Canciones en proyecto: {len(proyecto.canciones)}")
     print("=" * 60)
 
-    # Ejecutar servidor
-    app.run(debug=True, use_reloader=False, host='0.0.0.0', port=3838)
+    # Con waitress instalado se usa como servidor: entrega los WAV mediante
+    # wsgi.file_wrapper en lugar de iterar el archivo en Python.
+    # FLASK_DEBUG=1 fuerza el servidor de desarrollo de Flask.
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+
+    debug = os.getenv("FLASK_DEBUG", "0").lower() in ("1", "true")
+
+    if serve is not None and not debug:
+        serve(app, host='0.0.0.0', port=3838, threads=8)
+    else:
+        # Ejecutar servidor (un hilo por petición: una separación larga no bloquea al resto)
+        app.run(debug=debug, use_reloader=False, host='0.0.0.0', port=3838, threaded=True)
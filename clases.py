@@ -3,21 +3,33 @@
 # Objetivo: separar la lógica de datos (modelo) del servidor (app.py)
 
 import os
-from procesamiento_audio import separate_stems, generate_accompaniment, mix_tracks
+import time
+import atexit
+import threading
+from procesamiento_audio import separate_stems, generate_accompaniment, mix_tracks, compute_file_hash, compute_partial_hash, validate_stems_integrity, HASH_PREFIX
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from gestor_archivos import GestorArchivos
 
+OUTPUTS_DIR = "outputs_remix"  # carpeta de resultados, servida en /outputs_remix/
+ESTADO_JSON = "estado_proyecto.json"
+GUARDADO_DEBOUNCE_SEG = 0.5    # los cambios dentro de esta ventana se escriben juntos
+
 class Pista:
     """
     Representa una pista (stem) individual de audio.
     Por ejemplo: voz, guitarra, bajo, batería...
     """
+    # __slots__: sin __dict__ por instancia (menos memoria y carga más rápida)
+    __slots__ = ("nombre", "archivo_ruta", "duracion_seg", "metadatos", "url")
+
     def __init__(self, nombre: str, archivo_ruta: str, duracion_seg: Optional[float] = None):
         self.nombre = nombre
         self.archivo_ruta = archivo_ruta  # ruta al archivo físico en disco
         self.duracion_seg = duracion_seg  # duración en segundos (si se conoce)
         self.metadatos = {}               # diccionario libre para tags adicionales
+        # URL pública, calculada una sola vez (ej: outputs_remix/htdemucs/cancion/vocals.wav)
+        self.url = OUTPUTS_DIR + "/" + os.path.relpath(archivo_ruta, OUTPUTS_DIR).replace(os.sep, "/")
 
     def __repr__(self):
         return f"Pista(nombre={self.nombre}, archivo={os.path.basename(self.archivo_ruta)})"
@@ -30,19 +42,32 @@ class Pista:
             "metadatos": self.metadatos
         }
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Pista":
+        """Reconstruye una pista guardada con to_dict()."""
+        pista = cls(data["nombre"], data["archivo_ruta"], data.get("duracion_seg"))
+        pista.metadatos = data.get("metadatos", {})
+        return pista
+
 
 class Cancion:
     """
     Representa un archivo de canción subido por el usuario.
     Mantiene metadatos básicos y referencia a pistas (si se separó en stems).
     """
+    __slots__ = ("titulo", "archivo_ruta", "formato", "tamanio_bytes", "hora_subida",
+                 "hash_archivo", "hash_parcial", "stems", "stems_verified_at", "metadatos")
+
     def __init__(self, titulo: str, archivo_ruta: str, formato: Optional[str] = None):
         self.titulo = titulo
         self.archivo_ruta = archivo_ruta
         self.formato = formato or self._infer_format()
         self.tamanio_bytes = self._get_size_bytes()
         self.hora_subida = datetime.now()
-        self.pistas: List[Pista] = []  # listas de Pista asociadas tras separación
+        self.hash_archivo: Optional[str] = None  # huella del contenido (ver compute_file_hash)
+        self.hash_parcial: Optional[str] = None  # huella de los primeros 4 KiB
+        self.stems: Dict[str, Pista] = {}  # pistas tras la separación, por nombre (vocals, drums...)
+        self.stems_verified_at: Optional[float] = None  # mtime de la carpeta de stems al validarlos
         self.metadatos = {}            # por ejemplo artista, album, bpm, etc.
 
     def _infer_format(self) -> Optional[str]:
@@ -58,8 +83,39 @@ class Cancion:
             return 0
 
     def agregar_pista(self, pista: Pista):
-        """Añade una pista a la canción (por ejemplo tras separar stems)."""
-        self.pistas.append(pista)
+        """Añade una pista a la canción (por ejemplo tras separar stems).
+        Una pista con el mismo nombre reemplaza a la anterior."""
+        self.stems[pista.nombre] = pista
+
+    def _mtime_stems(self) -> Optional[float]:
+        """mtime más reciente de las carpetas de stems (None si alguna no existe)."""
+        carpetas = {os.path.dirname(p.archivo_ruta) or "." for p in self.stems.values()}
+        try:
+            return max(os.stat(carpeta).st_mtime for carpeta in carpetas)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def marcar_stems_verificados(self):
+        """Registra que los stems actuales acaban de escribirse/validarse."""
+        self.stems_verified_at = self._mtime_stems()
+
+    def stems_en_cache(self) -> Dict[str, Pista]:
+        """
+        Devuelve una copia de las pistas ya separadas si siguen en disco ({} si no).
+        Solo escribimos nosotros en las carpetas de stems, así que mientras su
+        mtime no cambie se confía en el estado en memoria sin hacer stat
+        de cada archivo. Llamar con ProyectoAudio.lock tomado: una separación
+        en curso puede estar añadiendo pistas.
+        """
+        mtime = self._mtime_stems()
+        if mtime is None:
+            return {}
+        if mtime != self.stems_verified_at:
+            rutas = {n: p.archivo_ruta for n, p in self.stems.items()}
+            if len(validate_stems_integrity(rutas)) != len(rutas):
+                return {}
+            self.stems_verified_at = mtime
+        return dict(self.stems)
 
     def reproducir(self):
         print(f"Reproduciendo {self.titulo} desde {self.archivo_ruta}")
@@ -72,7 +128,7 @@ class Cancion:
             "formato": self.formato,
             "tam_kb": int(self.tamanio_bytes / 1024),
             "hora_subida": self.hora_subida.isoformat(),
-            "num_pistas": len(self.pistas)
+            "num_pistas": len(self.stems)
         }
 
     def to_dict(self) -> dict:
@@ -82,10 +138,43 @@ class Cancion:
             "formato": self.formato,
             "tamanio_bytes": self.tamanio_bytes,
             "hora_subida": self.hora_subida.isoformat(),
-            "pistas": [p.to_dict() for p in self.pistas],
+            "hash_archivo": self.hash_archivo,
+            "hash_parcial": self.hash_parcial,
+            "pistas": {n: p.to_dict() for n, p in self.stems.items()},
             "metadatos": self.metadatos
         }
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Cancion":
+        """
+        Reconstruye una canción guardada con to_dict().
+        No pasa por __init__: formato y tamaño ya vienen en el JSON,
+        así que no se hace os.path.getsize por cada canción restaurada.
+        """
+        cancion = cls.__new__(cls)
+        cancion.titulo = data["titulo"]
+        cancion.archivo_ruta = data["archivo_ruta"]
+        cancion.formato = data.get("formato") or cancion._infer_format()
+        cancion.tamanio_bytes = data.get("tamanio_bytes", 0)
+        hora_subida = data.get("hora_subida")
+        cancion.hora_subida = datetime.fromisoformat(hora_subida) if hora_subida else datetime.now()
+        # Las huellas de otro algoritmo (p. ej. guardadas antes de instalar blake3)
+        # no son comparables: se descartan y se recalculan cuando hagan falta
+        for campo in ("hash_archivo", "hash_parcial"):
+            valor = data.get(campo)
+            setattr(cancion, campo, valor if valor and valor.startswith(HASH_PREFIX) else None)
+        cancion.stems = {}
+        cancion.stems_verified_at = None
+        cancion.metadatos = data.get("metadatos", {})
+
+        # Pistas: dict por nombre (los estados antiguos guardaban una lista)
+        pistas = data.get("pistas") or {}
+        if isinstance(pistas, dict):
+            pistas = pistas.values()
+        for p_data in pistas:
+            cancion.agregar_pista(Pista.from_dict(p_data))
+        return cancion
+
     def __repr__(self):
         return f"Cancion(titulo={self.titulo}, archivo={os.path.basename(self.archivo_ruta)})"
 
@@ -97,8 +186,16 @@ class ProyectoAudio:
     def __init__(self, nombre_proyecto: str):
         self.nombre = nombre_proyecto
         self.canciones: List[Cancion] = []
+        # Índices para búsquedas O(1); se mantienen en agregar_cancion / cargar_estado
+        self._by_size: Dict[int, List[Cancion]] = {}  # tamaño en bytes -> canciones
+        self._by_hash: Dict[str, Cancion] = {}        # hash_archivo -> canción
+        self._by_filename: Dict[str, Cancion] = {}    # basename del archivo -> canción
+        self.lock = threading.RLock()  # el servidor atiende peticiones en varios hilos
+        self._dirty = threading.Event()  # hay cambios pendientes de guardar
+        self._writer: Optional[threading.Thread] = None
+        self._escritura_lock = threading.Lock()  # una escritura del JSON a la vez
         self.created_at = datetime.now()
-        self.outputs_dir = "outputs_remix"  # carpeta por defecto para resultados
+        self.outputs_dir = OUTPUTS_DIR  # carpeta por defecto para resultados
         os.makedirs(self.outputs_dir, exist_ok=True)
 
     def agregar_cancion(self, cancion):
@@ -109,15 +206,88 @@ class ProyectoAudio:
         if not isinstance(cancion, Cancion):
             raise TypeError(f"Se esperaba un objeto Cancion, pero se recibió {type(cancion).__name__}")
 
-        self.canciones.append(cancion)
+        with self.lock:
+            # Un archivo subido con el mismo nombre sobrescribe al anterior en disco,
+            # así que la canción anterior (y sus stems) deja de ser válida.
+            anterior = self._by_filename.get(os.path.basename(cancion.archivo_ruta))
+            if anterior is not None:
+                self._quitar(anterior)
+            self.canciones.append(cancion)
+            self._indexar(cancion)
         return cancion
 
+    def _quitar(self, cancion: Cancion):
+        """Elimina la canción del proyecto y de los índices."""
+        self.canciones.remove(cancion)
+        bucket = self._by_size.get(cancion.tamanio_bytes, [])
+        if cancion in bucket:
+            bucket.remove(cancion)
+        if self._by_hash.get(cancion.hash_archivo) is cancion:
+            del self._by_hash[cancion.hash_archivo]
+        if self._by_filename.get(os.path.basename(cancion.archivo_ruta)) is cancion:
+            del self._by_filename[os.path.basename(cancion.archivo_ruta)]
+
+    def _indexar(self, cancion: Cancion):
+        """Registra la canción en los índices de búsqueda (gana la primera registrada)."""
+        self._by_size.setdefault(cancion.tamanio_bytes, []).append(cancion)
+        self._by_filename.setdefault(os.path.basename(cancion.archivo_ruta), cancion)
+        if cancion.hash_archivo:
+            self._by_hash.setdefault(cancion.hash_archivo, cancion)
+
     def encontrar_cancion_por_archivo(self, filename: str) -> Optional[Cancion]:
         """Busca una canción por nombre de archivo (basename)."""
-        for c in self.canciones:
-            if os.path.basename(c.archivo_ruta) == filename:
-                return c
-        return None
+        return self._by_filename.get(filename)
+
+    def encontrar_cancion_por_hash(self, file_hash: str) -> Optional[Cancion]:
+        """Busca una canción por la huella de su contenido."""
+        return self._by_hash.get(file_hash)
+
+    def encontrar_duplicado(self, filepath: str, file_hash: Optional[str] = None) -> Tuple[Optional[Cancion], Optional[str]]:
+        """
+        Busca una canción con el mismo contenido que `filepath`.
+        Cascada: tamaño -> hash de los primeros 4 KiB -> hash completo.
+        En el caso habitual (archivo nuevo) no se lee el archivo o solo 4 KiB.
+        Si ya se conoce el hash completo (p. ej. calculado durante la subida)
+        se pasa en `file_hash` y no se vuelve a leer el archivo completo.
+        Devuelve (cancion_existente, hash_calculado); ambos pueden ser None.
+        """
+        candidatas = self._by_size.get(os.path.getsize(filepath))
+        if not candidatas:
+            return None, file_hash
+
+        partial = compute_partial_hash(filepath)
+        for c in candidatas:
+            if not os.path.exists(c.archivo_ruta):
+                continue
+            # Si la subida sobrescribió el archivo de la candidata ya no se puede
+            # hashear su contenido anterior: solo vale una huella ya conocida.
+            if os.path.abspath(c.archivo_ruta) == os.path.abspath(filepath):
+                if file_hash is None:
+                    file_hash = compute_file_hash(filepath)
+                if c.hash_archivo == file_hash:
+                    return c, file_hash
+                continue
+            if c.hash_parcial is None:
+                c.hash_parcial = compute_partial_hash(c.archivo_ruta)
+            if c.hash_parcial != partial:
+                continue
+            if file_hash is None:
+                file_hash = compute_file_hash(filepath)
+            if c.hash_archivo is None:
+                c.hash_archivo = compute_file_hash(c.archivo_ruta)
+                self._by_hash.setdefault(c.hash_archivo, c)
+            if c.hash_archivo == file_hash:
+                return c, file_hash
+        return None, file_hash
+
+    def asegurar_hash(self, cancion: Cancion) -> str:
+        """Devuelve el hash de la canción, calculándolo (una sola vez) si falta."""
+        if cancion.hash_archivo is None:
+            file_hash = compute_file_hash(cancion.archivo_ruta)  # fuera del lock: lee todo el archivo
+            with self.lock:
+                cancion.hash_archivo = file_hash
+                self._by_hash.setdefault(file_hash, cancion)
+        return cancion.hash_archivo
 
     def listar_canciones(self) -> List[dict]:
         """Devuelve una lista con información simple de las canciones del proyecto."""
@@ -136,35 +306,64 @@ class ProyectoAudio:
         return mix_tracks(vocal_wav, accomp_wav, out_path)
 
     def guardar_estado(self):
-        """Guarda la información completa del proyecto en JSON."""
-        gestor = GestorArchivos("estado_proyecto.json")
-        data = [c.to_dict() for c in self.canciones]
-        gestor.guardar_json(data)
+        """
+        Pide guardar el proyecto y vuelve enseguida.
+        Un hilo en segundo plano escribe el JSON, agrupando en una sola
+        escritura los cambios que lleguen dentro de GUARDADO_DEBOUNCE_SEG.
+        """
+        with self.lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._writer_loop, name="guardado-estado", daemon=True
+                )
+                self._writer.start()
+                atexit.register(self._guardar_pendiente)
+        self._dirty.set()
+
+    def _writer_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(GUARDADO_DEBOUNCE_SEG)
+            self._dirty.clear()
+            self.guardar_estado_ahora()
+
+    def _guardar_pendiente(self):
+        """Al salir, escribe los cambios que aún no se hayan guardado."""
+        if self._dirty.is_set():
+            self._dirty.clear()
+            self.guardar_estado_ahora()  # espera a que termine una escritura en curso
+
+    def guardar_estado_ahora(self):
+        """
+        Guarda la información completa del proyecto en JSON (síncrono).
+        Solo la copia de los datos se hace con self.lock: la serialización y la
+        escritura en disco no bloquean a las peticiones que modifican el proyecto.
+        """
+        gestor = GestorArchivos(ESTADO_JSON)
+        # La copia se toma dentro de _escritura_lock: las escrituras quedan en el
+        # mismo orden que las copias y una más vieja nunca pisa a una más nueva
+        with self._escritura_lock:
+            with self.lock:
+                data = [c.to_dict() for c in self.canciones]
+            gestor.guardar_json(data)
 
     def cargar_estado(self):
         """Carga canciones previamente guardadas (si existe el JSON)."""
-        gestor = GestorArchivos("estado_proyecto.json")
+        gestor = GestorArchivos(ESTADO_JSON)
         data = gestor.leer_json()
         if not data:
             raise ValueError("No saved state found")
         
         self.canciones = []
+        self._by_size = {}
+        self._by_hash = {}
+        self._by_filename = {}
         for c_data in data:
             try:
-                # Reconstruir Cancion
-                cancion = Cancion(c_data["titulo"], c_data["archivo_ruta"], c_data.get("formato"))
-                cancion.tamanio_bytes = c_data.get("tamanio_bytes", 0)
-                if "hora_subida" in c_data:
-                    cancion.hora_subida = datetime.fromisoformat(c_data["hora_subida"])
-                
-                # Reconstruir Pistas
-                for p_data in c_data.get("pistas", []):
-                    pista = Pista(p_data["nombre"], p_data["archivo_ruta"], p_data.get("duracion_seg"))
-                    pista.metadatos = p_data.get("metadatos", {})
-                    cancion.agregar_pista(pista)
-                
+                cancion = Cancion.from_dict(c_data)
                 self.canciones.append(cancion)
-                print(f"Canción restaurada: {cancion.titulo} con {len(cancion.pistas)} pistas")
+                self._indexar(cancion)
+                print(f"Canción restaurada: {cancion.titulo} con {len(cancion.stems)} pistas")
             except Exception as e:
                 print(f"Error al restaurar canción desde estado: {e}")
 
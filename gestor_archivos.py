@@ -1,6 +1,15 @@
 import json
+import logging
 import os
 
+# orjson (C, SIMD) es mucho más rápido que json; si no está instalado se usa la stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 #=== CLASE GESTORARCHIVOS ===
 class GestorArchivos:
     """
@@ -12,27 +21,37 @@ class GestorArchivos:
         self.ruta_archivo = ruta_archivo
 
     def guardar_json(self, datos):
-        """Guarda los datos (listas o diccionarios) en un archivo JSON."""
+        """Guarda los datos (listas o diccionarios) en un archivo JSON.
+        Se escribe en un temporal y se renombra: nunca queda un JSON a medias."""
+        ruta_tmp = self.ruta_archivo + ".tmp"
         try:
-            with open(self.ruta_archivo, "w", encoding="utf-8") as archivo:
-                json.dump(datos, archivo, indent=2, ensure_ascii=False)
-            print(f"✅ Datos guardados correctamente en {self.ruta_archivo}")
+            if orjson is not None:
+                with open(ruta_tmp, "wb") as archivo:
+                    archivo.write(orjson.dumps(datos, option=orjson.OPT_INDENT_2))
+            else:
+                with open(ruta_tmp, "w", encoding="utf-8") as archivo:
+                    json.dump(datos, archivo, indent=2, ensure_ascii=False)
+            os.replace(ruta_tmp, self.ruta_archivo)
+            logger.debug("✅ Datos guardados correctamente en %s", self.ruta_archivo)
         except Exception as e:
-            print(f"❌ Error al guardar JSON: {e}")
+            logger.error("❌ Error al guardar JSON: %s", e)
 
     def leer_json(self):
         """Lee el JSON del archivo y devuelve los datos."""
         if not os.path.exists(self.ruta_archivo):
-            print(f"⚠️ Archivo {self.ruta_archivo} no encontrado.")
+            logger.debug("⚠️ Archivo %s no encontrado.", self.ruta_archivo)
             return None
         try:
+            if orjson is not None:
+                with open(self.ruta_archivo, "rb") as archivo:
+                    return orjson.loads(archivo.read())
             with open(self.ruta_archivo, "r", encoding="utf-8") as archivo:
                 return json.load(archivo)
         except json.JSONDecodeError:
-            print(f"❌ Error: El archivo {self.ruta_archivo} no contiene JSON válido.")
+            logger.error("❌ Error: El archivo %s no contiene JSON válido.", self.ruta_archivo)
             return None
         except Exception as e:
-            print(f"❌ Error al leer JSON: {e}")
+            logger.error("❌ Error al leer JSON: %s", e)
             return None
 
 
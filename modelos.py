@@ -1,8 +1,15 @@
 # modelos.py
 # Lazy loading para evitar errores de importación en startup
 
+import os
+import threading
+
 MODEL_DEMUCS = "htdemucs"
 MODEL_MUSICGEN = "facebook/musicgen-small"
+# Cuantización de MusicGen en GPU: "4bit" (NF4), "8bit" o "none" (FP16/FP32)
+MUSICGEN_QUANT = os.getenv("MUSICGEN_QUANT", "4bit").lower()
+# torch.compile del decoder de MusicGen (opcional: la primera generación tarda más)
+MUSICGEN_COMPILE = os.getenv("MUSICGEN_COMPILE", "0") == "1"
 
 # -------------------------------------------------------
 # CARGA DIFERIDA (lazy loading)
@@ -13,48 +20,122 @@ MODEL_MUSICGEN = "facebook/musicgen-small"
 _demucs_model = None
 _musicgen_processor = None
 _musicgen_model = None
+# Evita que dos peticiones simultáneas carguen el mismo modelo dos veces
+_carga_lock = threading.Lock()
 
 
 def get_demucs_model():
     """Carga el modelo Demucs solo cuando se necesita"""
     global _demucs_model
-    if _demucs_model is None:
-        print("⏳ Cargando modelo Demucs (solo la primera vez)...")
-        try:
-            import torch
-            from demucs.pretrained import get_model
-            DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-            _demucs_model = get_model(MODEL_DEMUCS).to(DEVICE).eval()
-            print("✅ Demucs cargado exitosamente")
-        except Exception as e:
-            print(f"❌ Error al cargar Demucs: {e}")
-            raise
+    if _demucs_model is not None:
+        return _demucs_model
+    with _carga_lock:
+        if _demucs_model is None:
+            print("⏳ Cargando modelo Demucs (solo la primera vez)...")
+            try:
+                import torch
+                from demucs.pretrained import get_model
+                DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+                _demucs_model = get_model(MODEL_DEMUCS).to(DEVICE).eval()
+                print("✅ Demucs cargado exitosamente")
+            except Exception as e:
+                print(f"❌ Error al cargar Demucs: {e}")
+                raise
     return _demucs_model
 
 
+def _accelerate_disponible():
+    try:
+        import accelerate  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _musicgen_quantization_config(torch, device):
+    """Configuración de bitsandbytes según MUSICGEN_QUANT (None = sin cuantizar).
+    Solo aplica en CUDA y si bitsandbytes está instalado."""
+    if MUSICGEN_QUANT not in ("4bit", "8bit") or device != "cuda":
+        return None
+    try:
+        import bitsandbytes  # noqa: F401
+        from transformers import BitsAndBytesConfig
+    except ImportError:
+        print("⚠️ bitsandbytes no está instalado: MusicGen se carga sin cuantizar")
+        return None
+
+    # El codec de audio (EnCodec) se deja en FP16
+    if MUSICGEN_QUANT == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=["audio_encoder"])
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.float16,
+        llm_int8_skip_modules=["audio_encoder"],
+    )
+
+
 def get_musicgen():
     """Carga MusicGen solo cuando se necesita"""
     global _musicgen_processor, _musicgen_model
 
-    if _musicgen_processor is None or _musicgen_model is None:
-        print("⏳ Cargando modelo MusicGen (solo la primera vez)...")
-        try:
-            import torch
-            from transformers import AutoProcessor, MusicgenForConditionalGeneration
-            DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    if _musicgen_processor is not None and _musicgen_model is not None:
+        return _musicgen_processor, _musicgen_model
+    with _carga_lock:
+        if _musicgen_processor is None or _musicgen_model is None:
+            print("⏳ Cargando modelo MusicGen (solo la primera vez)...")
+            try:
+                import torch
+                from transformers import AutoProcessor, MusicgenForConditionalGeneration
+                DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
             
-            _musicgen_processor = AutoProcessor.from_pretrained(
-                MODEL_MUSICGEN,
-                force_download=False,      # No fuerza descargas cada vez
-                local_files_only=False     # Usa primero cache local
-            )
-            _musicgen_model = MusicgenForConditionalGeneration.from_pretrained(
-                MODEL_MUSICGEN,
-                force_download=False,
-                local_files_only=False
-            ).to(DEVICE)
-            print("✅ MusicGen cargado exitosamente")
-        except Exception as e:
-            print(f"❌ Error al cargar MusicGen: {e}")
-            raise
+                _musicgen_processor = AutoProcessor.from_pretrained(
+                    MODEL_MUSICGEN,
+                    force_download=False,      # No fuerza descargas cada vez
+                    local_files_only=False     # Usa primero cache local
+                )
+                quantization_config = _musicgen_quantization_config(torch, DEVICE)
+                if quantization_config is not None:
+                    # Los pesos cuantizados se cargan directamente en la GPU
+                    _musicgen_model = MusicgenForConditionalGeneration.from_pretrained(
+                        MODEL_MUSICGEN,
+                        force_download=False,
+                        local_files_only=False,
+                        quantization_config=quantization_config,
+                        torch_dtype=torch.float16,
+                        device_map={"": DEVICE}
+                    )
+                    print(f"🗜️ MusicGen cuantizado ({MUSICGEN_QUANT})")
+                else:
+                    # En GPU se usa FP16: la mitad de memoria y tensor cores en los matmul.
+                    # Los pesos se crean ya en ese dtype; con accelerate, además, se cargan
+                    # sin inicializar antes una copia aleatoria en RAM (low_cpu_mem_usage).
+                    carga_directa = _accelerate_disponible()
+                    _musicgen_model = MusicgenForConditionalGeneration.from_pretrained(
+                        MODEL_MUSICGEN,
+                        force_download=False,
+                        local_files_only=False,
+                        torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32,
+                        low_cpu_mem_usage=carga_directa,
+                        device_map={"": DEVICE} if carga_directa else None
+                    ).to(DEVICE)
+                _musicgen_model.eval()
+                # El decoder se ejecuta una vez por token: compilarlo fusiona sus kernels.
+                # Sin CUDA graphs y con formas dinámicas, porque la caché KV crece en cada
+                # paso (con formas fijas se recompilaría por longitud). Los pesos de
+                # bitsandbytes no se compilan bien, así que solo se hace sin cuantizar.
+                if MUSICGEN_COMPILE and DEVICE == "cuda":
+                    if quantization_config is not None:
+                        print("⚠️ MUSICGEN_COMPILE se ignora con MusicGen cuantizado")
+                    else:
+                        _musicgen_model.decoder.forward = torch.compile(
+                            _musicgen_model.decoder.forward,
+                            mode="max-autotune-no-cudagraphs",
+                            dynamic=True,
+                        )
+                        print("⚙️ Decoder de MusicGen compilado con torch.compile")
+                print("✅ MusicGen cargado exitosamente")
+            except Exception as e:
+                print(f"❌ Error al cargar MusicGen: {e}")
+                raise
     return _musicgen_processor, _musicgen_model
\ No newline at end of file
@@ -1,8 +1,17 @@
 import os
+import shutil
+import hashlib
+import logging
 import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import MemoryHandler, RotatingFileHandler
 from typing import List
 from pathlib import Path
 
+from gestor_archivos import GestorArchivos
+
 # Lazy imports - only when needed
 # import numpy as np
 # import torch
@@ -13,6 +22,35 @@ from pathlib import Path
 # GLOBAL SETTINGS
 # =========================
 SAMPLE_RATE = 32000
+HASH_DIGEST_SIZE = 16        # 128 bits: suficiente como clave de caché (no es uso criptográfico)
+HASH_CHUNK_SIZE = 256 * 1024  # lectura en bloques de 256 KiB (caben en la caché L2)
+PARTIAL_HASH_SIZE = 4096     # bytes iniciales usados para el hash parcial
+MIN_STEM_BYTES = 1000        # un stem de menos de 1KB probablemente indica error
+STEM_NAMES = ["vocals", "drums", "bass", "other"]  # salidas de htdemucs
+STEM_CACHE_MANIFEST = ".stem_cache.json"  # ruta -> {mtime, tamaño, hash} de los audios ya hasheados
+# "inproc": Demucs corre en este proceso con el modelo ya cargado (modelos.py)
+# "cli": se lanza el comando `demucs` (nuevo proceso + recarga del modelo cada vez)
+DEMUCS_BACKEND = os.getenv("DEMUCS_BACKEND", "inproc")
+
+# =========================
+# ERRORES DE DEMUCS
+# =========================
+# Subclases de RuntimeError: quien ya captura RuntimeError sigue funcionando
+class DemucsSubprocessError(RuntimeError):
+    """Demucs terminó con error."""
+
+
+class DemucsMissingOutputError(RuntimeError):
+    """Demucs no generó la carpeta de salida esperada."""
+
+
+class DemucsEmptyStemsError(RuntimeError):
+    """Demucs terminó pero todos los stems faltan o están vacíos."""
+
+
+# Mensajes de la separación (ruta de /separar): van por logging como en app.py
+logger = logging.getLogger(__name__)
+
 
 def get_device():
     """Get torch device lazily"""
@@ -25,26 +63,205 @@ def get_device():
 # =========================
 # UTILS
 # =========================
-def log(msg: str):
-    """Print to console and write to remix.log"""
+# remix.log se abre una sola vez (no en cada mensaje) y se escribe en bloques:
+# MemoryHandler acumula hasta 64 líneas (o un error) antes de volcarlas al archivo
+_remix_log = logging.getLogger("remix")
+_remix_log.propagate = False
+if not _remix_log.handlers:
+    _remix_file = RotatingFileHandler(
+        "remix.log", maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8", delay=True
+    )
+    _remix_log.addHandler(MemoryHandler(64, flushLevel=logging.ERROR, target=_remix_file))
+    _remix_log.setLevel(logging.INFO)
+
+
+def log(msg: str, level: int = logging.INFO):
+    """Print to console and write to remix.log.
+    Con level=logging.ERROR el búfer se vuelca enseguida al archivo."""
     print(msg, flush=True)
+    _remix_log.log(level, msg)
+
+
+def _seleccionar_hasher():
+    """
+    Elige el hasher más rápido disponible y devuelve (nombre, constructor).
+    Orden: BLAKE3 (SIMD + multihilo) -> xxh3_128 -> BLAKE2b de la stdlib.
+    """
     try:
-        with open("remix.log", "a", encoding="utf-8") as f:
-            f.write(msg + "\n")
-    except Exception as e:
-        print(f"No se pudo escribir en log: {e}")
+        import blake3
+        return "blake3", lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
+    except ImportError:
+        pass
+    try:
+        import xxhash
+        return "xxh3", xxhash.xxh3_128
+    except ImportError:
+        return "blake2b", lambda: hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+
+
+# Cada huella lleva delante el algoritmo ("blake3-<hex>"): si cambia el backend
+# instalado, las huellas guardadas con otro no se confunden con las nuevas
+HASH_ALGO, _hasher_factory = _seleccionar_hasher()
+HASH_PREFIX = f"{HASH_ALGO}-"
+
+
+def _new_hasher():
+    return _hasher_factory()
+
+
+def _hexdigest(hasher) -> str:
+    """Huella "<algoritmo>-<hex de 128 bits>", independiente del backend usado."""
+    if HASH_ALGO == "blake3":
+        return HASH_PREFIX + hasher.hexdigest(length=HASH_DIGEST_SIZE)
+    return HASH_PREFIX + hasher.hexdigest()
+
+
+def compute_file_hash(filepath) -> str:
+    """
+    Calcula la huella del contenido de un archivo.
+    Solo se usa para reconocer archivos idénticos ya subidos (clave de caché).
+    """
+    hasher = _new_hasher()
+    # BLAKE3 puede mapear el archivo en memoria y repartir el árbol de hash
+    # entre varios hilos: es lo más rápido para archivos grandes
+    if hasattr(hasher, "update_mmap"):
+        hasher.update_mmap(filepath)
+        return _hexdigest(hasher)
+
+    # Buffer reutilizado: readinto evita crear un bytes nuevo por bloque
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filepath, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            hasher.update(view[:n])
+    return _hexdigest(hasher)
+
+
+def stream_to_disk_and_hash(src_stream, dst_path):
+    """
+    Copia un stream a disco calculando su hash en la misma pasada,
+    para no tener que volver a leer el archivo después.
+    Devuelve (dst_path, hash_hex).
+    """
+    hasher = _new_hasher()
+    with open(dst_path, "wb") as f:
+        for chunk in iter(lambda: src_stream.read(HASH_CHUNK_SIZE), b""):
+            f.write(chunk)
+            hasher.update(chunk)
+    return dst_path, _hexdigest(hasher)
+
+
+def compute_partial_hash(filepath, n: int = PARTIAL_HASH_SIZE) -> str:
+    """
+    Huella barata de los primeros `n` bytes del archivo.
+    Descarta casi todos los candidatos antes de calcular el hash completo.
+    """
+    hasher = _new_hasher()
+    with open(filepath, "rb") as f:
+        hasher.update(f.read(n))
+    return _hexdigest(hasher)
+
+
+def validate_stems_integrity(stems: dict) -> dict:
+    """
+    Devuelve solo los stems {nombre: ruta} que existen y no están vacíos.
+    Agrupa las rutas por carpeta y hace un único os.scandir por carpeta
+    en lugar de os.path.exists + os.path.getsize por archivo.
+    """
+    por_carpeta = {}
+    for name, path in stems.items():
+        por_carpeta.setdefault(os.path.dirname(path), []).append((name, path))
+
+    validos = {}
+    for carpeta, items in por_carpeta.items():
+        try:
+            with os.scandir(carpeta or ".") as it:
+                entradas = {e.name: e for e in it}
+        except FileNotFoundError:
+            continue
+        for name, path in items:
+            entrada = entradas.get(os.path.basename(path))
+            if entrada is not None and entrada.is_file() and entrada.stat().st_size > MIN_STEM_BYTES:
+                validos[name] = path
+    return validos
+
+
+def stems_dir_for_hash(out_dir, file_hash) -> str:
+    """Carpeta de stems direccionada por contenido: out_dir/stems/<hash>/"""
+    return os.path.join(out_dir, "stems", file_hash)
+
+
+def find_cached_stems(out_dir, file_hash, names=STEM_NAMES) -> dict:
+    """
+    Devuelve los stems `names` ya separados para ese contenido ({} si falta alguno).
+    Da igual con qué nombre se subió el archivo: la clave es su hash.
+    """
+    carpeta = stems_dir_for_hash(out_dir, file_hash)
+    stems = validate_stems_integrity(
+        {name: os.path.join(carpeta, f"{name}.wav") for name in names}
+    )
+    return stems if len(stems) == len(names) else {}
+
+
+def store_stems_by_hash(stems: dict, out_dir, file_hash) -> dict:
+    """Mueve los stems recién generados a out_dir/stems/<hash>/ y devuelve las nuevas rutas."""
+    carpeta = stems_dir_for_hash(out_dir, file_hash)
+    os.makedirs(carpeta, exist_ok=True)
+    movidos = {}
+    for name, path in stems.items():
+        destino = os.path.join(carpeta, os.path.basename(path))
+        os.replace(path, destino)
+        movidos[name] = destino
+    return movidos
+
+
+_manifest_lock = threading.Lock()
+
+
+def _read_manifest(gestor) -> dict:
+    return gestor.leer_json() or {}
+
+
+def hash_with_manifest(input_audio, out_dir) -> str:
+    """
+    Hash del contenido de input_audio, recordado en out_dir/.stem_cache.json.
+    Si el archivo conserva el mismo mtime y tamaño no se vuelve a leer; si se
+    sobrescribió con otro audio, el hash cambia y no se sirven stems viejos.
+    """
+    ruta = os.path.abspath(input_audio)
+    st = os.stat(ruta)
+    gestor = GestorArchivos(os.path.join(out_dir, STEM_CACHE_MANIFEST))
+
+    with _manifest_lock:
+        entrada = _read_manifest(gestor).get(ruta)
+        if (entrada and entrada["mtime"] == st.st_mtime and entrada["size"] == st.st_size
+                and entrada["hash"].startswith(HASH_PREFIX)):
+            return entrada["hash"]
+
+    file_hash = compute_file_hash(ruta)
+
+    with _manifest_lock:
+        manifest = _read_manifest(gestor)
+        manifest[ruta] = {"mtime": st.st_mtime, "size": st.st_size, "hash": file_hash}
+        gestor.guardar_json(manifest)
+
+    return file_hash
 
 
 def ensure_dir(path):
     Path(path).mkdir(parents=True, exist_ok=True)
 
 
-def save_audio(path, audio, sr=SAMPLE_RATE):
-    """Guarda audio en formato WAV"""
+def save_audio(path, audio, sr=SAMPLE_RATE, subtype="PCM_16"):
+    """
+    Guarda audio en formato WAV.
+    Por defecto PCM de 16 bits (la mitad que float32); el audio ya viene
+    normalizado a [-1, 1]. Usar subtype="FLOAT" si se necesita más precisión.
+    """
     import soundfile as sf
     if audio.ndim > 1:
         audio = audio.T
-    sf.write(path, audio, sr)
+    sf.write(path, audio, sr, subtype=subtype)
     log(f"Audio guardado: {path}")
 
 
@@ -52,153 +269,263 @@ def save_audio(path, audio, sr=SAMPLE_RATE):
 # FUNCIONES PRINCIPALES
 # =========================
 
-def separate_stems(input_audio, out_dir):
+def separate_stems(input_audio, out_dir, file_hash=None, stems=None):
     """
     Separa un archivo de audio en stems usando Demucs.
     
     Args:
         input_audio: Ruta al archivo de audio a separar
         out_dir: Directorio donde guardar los stems
+        file_hash: Hash del contenido (opcional; si falta se calcula con
+                   hash_with_manifest). Los stems se guardan en
+                   out_dir/stems/<hash>/ y, si ya existen ahí, se devuelven
+                   sin ejecutar Demucs.
+        stems: Un único stem a extraer (ej. "vocals"), o None para los 4.
+               Con un stem, Demucs corre en modo --two-stems y solo se
+               escribe/devuelve ese stem.
     
     Returns:
         dict: Diccionario con los paths a cada stem {stem_name: path}
-              Stems: vocals, drums, bass, other
+              Stems: vocals, drums, bass, other (o solo el pedido)
     
     Raises:
         FileNotFoundError: Si el archivo de entrada no existe
-        RuntimeError: Si Demucs falla o no genera los outputs esperados
+        ValueError: Si `stems` no es un stem conocido
+        DemucsSubprocessError: Si Demucs falla
+        DemucsMissingOutputError: Si no aparece la carpeta de salida
+        DemucsEmptyStemsError: Si todos los stems faltan o están vacíos
+        (las tres son RuntimeError)
     """
     if not os.path.exists(input_audio):
         raise FileNotFoundError(f"El archivo no existe: {input_audio}")
 
+    if stems is not None and stems not in STEM_NAMES:
+        raise ValueError(f"Stem desconocido: {stems} (opciones: {', '.join(STEM_NAMES)})")
+    names = STEM_NAMES if stems is None else [stems]
+
     os.makedirs(out_dir, exist_ok=True)
 
-    print("🎵 Iniciando separación de stems con Demucs...")
-    print(f"📁 Archivo: {input_audio}")
-    print(f"📁 Salida: {out_dir}")
+    if not file_hash:
+        file_hash = hash_with_manifest(input_audio, out_dir)
+
+    cached = find_cached_stems(out_dir, file_hash, names)
+    if cached:
+        logger.info("♻️ Stems ya separados para este contenido: %s", file_hash)
+        return cached
+
+    logger.info("🎵 Iniciando separación de stems con Demucs: %s", input_audio)
+    logger.debug("📁 Salida: %s", out_dir)
+
+    # Cada separación escribe en su propia carpeta temporal dentro de stems/
+    # (mismo sistema de archivos: los stems se mueven con os.replace). Dos
+    # separaciones simultáneas de archivos con el mismo nombre no se pisan.
+    stems_root = os.path.join(out_dir, "stems")
+    os.makedirs(stems_root, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=stems_root)
 
     try:
         # Nombre del archivo sin extensión (para ubicar la carpeta de salida)
         song_name = os.path.splitext(os.path.basename(input_audio))[0]
-        
-        # Comando Demucs
-        # -n htdemucs: usa el modelo pre-entrenado htdemucs (mejor calidad)
-        # -o out_dir: directorio de salida
-        # --two-stems: Opción comentada por ahora, usa 4 stems por defecto
-        command = [
-            "demucs",
-            "-n", "htdemucs",
-            "-o", out_dir,
-            input_audio
-        ]
-        
-        print(f"🔧 Ejecutando: {' '.join(command)}")
-        
-        # Ejecutar Demucs (bloqueante - espera a que termine)
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        
-        stdout, stderr = process.communicate()
-        
-        # Imprimir output de Demucs para debugging
-        if stdout:
-            print("📋 Output de Demucs:")
-            print(stdout)
-        
-        if process.returncode != 0:
-            print(f"❌ Error de Demucs:\n{stderr}")
-            raise RuntimeError(f"Demucs falló con código {process.returncode}: {stderr}")
-        
-        # Demucs guarda en: out_dir/htdemucs/song_name/{vocals,drums,bass,other}.wav
-        demucs_output_dir = os.path.join(out_dir, "htdemucs", song_name)
+
+        # Ambos backends dejan: tmp_dir/htdemucs/song_name/{vocals,drums,bass,other}.wav
+        demucs_output_dir = os.path.join(tmp_dir, "htdemucs", song_name)
+
+        if DEMUCS_BACKEND == "cli":
+            _run_demucs_cli(input_audio, tmp_dir, two_stems=stems)
+        else:
+            _run_demucs_inproc(input_audio, demucs_output_dir, names)
         
         if not os.path.exists(demucs_output_dir):
-            raise RuntimeError(
+            raise DemucsMissingOutputError(
                 f"Demucs no generó la carpeta esperada: {demucs_output_dir}"
             )
         
-        # Construir diccionario de stems
-        stems = {}
-        expected_stems = ["vocals", "drums", "bass", "other"]
-        
-        for stem_name in expected_stems:
-            stem_path = os.path.join(demucs_output_dir, f"{stem_name}.wav")
-            
-            if not os.path.exists(stem_path):
-                print(f"⚠️  Stem no encontrado: {stem_name}")
-                continue
-            
-            # Verificar que el archivo no esté vacío
-            size = os.path.getsize(stem_path)
-            if size < 1000:  # Menos de 1KB probablemente indica error
-                print(f"⚠️  Stem {stem_name} muy pequeño ({size} bytes), ignorando")
-                continue
-            
-            stems[stem_name] = stem_path
-            print(f"✅ Stem generado: {stem_name} ({size:,} bytes)")
+        # Construir diccionario de stems: un único os.scandir de la carpeta
+        # (descarta los que faltan o pesan menos de MIN_STEM_BYTES)
+        resultado = validate_stems_integrity(
+            {name: os.path.join(demucs_output_dir, f"{name}.wav") for name in names}
+        )
+        for stem_name in names:
+            if stem_name in resultado:
+                logger.debug("✅ Stem generado: %s", stem_name)
+            else:
+                logger.warning("⚠️ Stem no encontrado o vacío: %s", stem_name)
         
-        if not stems:
-            raise RuntimeError(
+        if not resultado:
+            raise DemucsEmptyStemsError(
                 "Demucs se ejecutó pero todos los stems salieron vacíos o no se generaron. "
                 "Verifica que el archivo de entrada sea un audio válido."
             )
         
-        print(f"🎉 Separación completada exitosamente: {len(stems)} stems")
-        return stems
+        resultado = store_stems_by_hash(resultado, out_dir, file_hash)
+
+        logger.info("🎉 Separación completada exitosamente: %d stems", len(resultado))
+        return resultado
         
     except FileNotFoundError as e:
-        print(f"❌ Archivo no encontrado: {e}")
+        logger.error("❌ Archivo no encontrado: %s", e)
         raise
     except subprocess.CalledProcessError as e:
-        print(f"❌ Error ejecutando Demucs: {e}")
-        raise RuntimeError(f"Error ejecutando Demucs: {e}")
+        logger.error("❌ Error ejecutando Demucs: %s", e)
+        raise DemucsSubprocessError(f"Error ejecutando Demucs: {e}")
     except Exception as e:
-        print(f"❌ Error inesperado en separación: {e}")
+        logger.error("❌ Error inesperado en separación: %s", e)
         raise
+    finally:
+        # Se borra la carpeta temporal con lo que no se movió (p. ej. no_vocals.wav
+        # con --two-stems, o una salida a medias si Demucs falló)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
-def generate_accompaniment(style_prompt, out_path, duration=10):
+# Un único modelo Demucs residente: las inferencias se hacen de a una para no
+# agotar la memoria de la GPU ni repartir los núcleos entre varias a la vez.
+# La lectura del audio y la escritura de los stems quedan fuera del lock.
+_demucs_lock = threading.Lock()
+
+
+def _run_demucs_inproc(input_audio, demucs_output_dir, names=STEM_NAMES):
     """
-    Genera un acompañamiento musical con MusicGen.
-    Default duration: 10s
+    Separa con el modelo Demucs residente en memoria (modelos.get_demucs_model()).
+    Evita lanzar un proceso nuevo, reimportar torch y recargar el checkpoint en cada llamada.
+    Solo se escriben los stems de `names`.
     """
     import torch
-    import numpy as np
-    from modelos import get_musicgen
+    import soundfile as sf
+    from demucs.apply import apply_model
+    from demucs.audio import AudioFile, prevent_clip
+    from modelos import get_demucs_model
+
+    model = get_demucs_model()
+    logger.debug("🔧 Demucs en proceso (%s)", get_device())
+
+    wav = AudioFile(input_audio).read(
+        streams=0, samplerate=model.samplerate, channels=model.audio_channels
+    )
+    # Misma normalización que aplica el CLI de Demucs
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / ref.std()
+
+    with _demucs_lock, torch.inference_mode():
+        sources = apply_model(
+            model, wav[None], device=get_device(), shifts=0, split=True, overlap=0.25
+        )[0]
+    sources = sources * ref.std() + ref.mean()
+
+    os.makedirs(demucs_output_dir, exist_ok=True)
+    # Una sola copia a CPU de todos los stems; luego se escriben en paralelo
+    # (libsndfile libera el GIL mientras codifica). Como el CLI: cada stem se
+    # reescala si se sale de [-1, 1] (prevent_clip) y se guarda en WAV de 16 bits
+    sources = sources.cpu()
+    with ThreadPoolExecutor(max_workers=len(names)) as ex:
+        futures = [
+            ex.submit(
+                sf.write, os.path.join(demucs_output_dir, f"{name}.wav"),
+                prevent_clip(source, mode="rescale").numpy().T, model.samplerate,
+                subtype="PCM_16"
+            )
+            for name, source in zip(model.sources, sources)
+            if name in names
+        ]
+        for future in futures:
+            future.result()
+
+
+def _run_demucs_cli(input_audio, out_dir, two_stems=None):
+    """Ejecuta el comando `demucs` en un proceso aparte (bloqueante)."""
+    # Comando Demucs
+    # -n htdemucs: usa el modelo pre-entrenado htdemucs (mejor calidad)
+    # -o out_dir: directorio de salida
+    # --two-stems X: solo escribe X y no_X (por defecto, los 4 stems)
+    command = [
+        "demucs",
+        "-n", "htdemucs",
+        "-o", out_dir,
+    ]
+    if two_stems:
+        command += ["--two-stems", two_stems]
+    command.append(input_audio)
+    
+    logger.debug("🔧 Ejecutando: %s", " ".join(command))
+    
+    # Ejecutar Demucs (bloqueante - espera a que termine)
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
     
+    stdout, stderr = process.communicate()
+    
+    # Output de Demucs para debugging
+    if stdout:
+        logger.debug("📋 Output de Demucs:\n%s", stdout)
+    
+    if process.returncode != 0:
+        logger.error("❌ Error de Demucs:\n%s", stderr)
+        raise DemucsSubprocessError(f"Demucs falló con código {process.returncode}: {stderr}")
+
+
+def generate_batch(prompts: List[str], out_paths: List[str], duration=10):
+    """
+    Genera varios audios con MusicGen en una sola llamada a generate():
+    todos los prompts van en el mismo batch y comparten el coste de la GPU.
+    El audio de prompts[i] se guarda en out_paths[i].
+    """
+    import torch
+    from modelos import get_musicgen
+
+    if len(prompts) != len(out_paths):
+        raise ValueError("Debe haber una ruta de salida por cada prompt")
+
     DEVICE = get_device()
     musicgen_processor, musicgen_model = get_musicgen()
-    
+
+    inputs = musicgen_processor(
+        text=list(prompts),
+        return_tensors="pt",
+        padding=True
+    ).to(DEVICE)
+
+    log(f"Generando audio con MusicGen ({len(prompts)} prompts)...")
+    # inference_mode: sin registro de autograd (más barato que no_grad)
+    with torch.inference_mode():
+        audio = musicgen_model.generate(
+            **inputs,
+            max_new_tokens=int(duration * SAMPLE_RATE / 256),
+            use_cache=True  # KV-cache: cada paso solo procesa el token nuevo
+        )
+
+    # Normalizar en el dispositivo (todo el batch a la vez) y copiar a CPU una vez.
+    # En GPU el modelo es FP16: se pasa a float32 y se limpian posibles NaN/inf
+    wav = torch.nan_to_num(audio[:, 0].float(), nan=0.0, posinf=0.0, neginf=0.0)
+    wav = wav / wav.abs().amax(dim=1, keepdim=True).clamp_min(1e-9)
+    if wav.is_cuda:
+        # Copia GPU -> CPU por DMA a memoria fijada (pinned), sin búfer intermedio
+        host = torch.empty(wav.shape, dtype=wav.dtype, pin_memory=True)
+        host.copy_(wav, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        wav = host
+    for out_path, arr in zip(out_paths, wav.cpu().numpy()):
+        save_audio(out_path, arr, SAMPLE_RATE)
+    return list(out_paths)
+
+
+def generate_accompaniment(style_prompt, out_path, duration=10):
+    """
+    Genera un acompañamiento musical con MusicGen.
+    Default duration: 10s
+    """
     prompt = f"background music in {style_prompt} style"
     log(f"Generando acompañamiento: {prompt} ({duration}s)")
 
     try:
-        inputs = musicgen_processor(
-            text=prompt,
-            return_tensors="pt",
-            padding=True
-        ).to(DEVICE)
-
-        log("Generando audio con MusicGen...")
-        with torch.no_grad():
-            audio = musicgen_model.generate(
-                **inputs,
-                max_new_tokens=int(duration * SAMPLE_RATE / 256)
-            )
-
-        # Normalizar y guardar
-        arr = audio[0, 0].cpu().numpy()
-        arr = arr / (np.max(np.abs(arr)) + 1e-9)
-        save_audio(out_path, arr, SAMPLE_RATE)
+        generate_batch([prompt], [out_path], duration)
         log(f"Acompañamiento generado → {out_path}")
         return out_path
 
     except Exception as e:
-        log(f"❌ Error en generación: {e}")
+        log(f"❌ Error en generación: {e}", logging.ERROR)
         raise
 
 
@@ -207,49 +534,41 @@ def generate_stem_variation(stem_type: str, style: str, out_path: str, duration:
     Genera una variación de un stem usando MusicGen (Text-to-Music).
     Crea un nuevo audio basado en el tipo de instrumento y el estilo.
     """
-    import torch
-    import numpy as np
-    from modelos import get_musicgen
-    
-    DEVICE = get_device()
-    musicgen_processor, musicgen_model = get_musicgen()
-    
     # Prompt engineering para aislar el instrumento
     prompt = f"solitary {stem_type} track, {style} style, high quality, loopable, no other instruments"
     log(f"Generando variación: {prompt} ({duration}s)")
 
     try:
-        inputs = musicgen_processor(
-            text=prompt,
-            return_tensors="pt",
-            padding=True
-        ).to(DEVICE)
-
-        log("Generando audio con MusicGen...")
-        with torch.no_grad():
-            audio = musicgen_model.generate(
-                **inputs,
-                max_new_tokens=int(duration * SAMPLE_RATE / 256)
-            )
-
-        # Normalizar y guardar
-        arr = audio[0, 0].cpu().numpy()
-        arr = arr / (np.max(np.abs(arr)) + 1e-9)
-        save_audio(out_path, arr, SAMPLE_RATE)
+        generate_batch([prompt], [out_path], duration)
         log(f"Variación generada → {out_path}")
         return out_path
 
     except Exception as e:
-        log(f"❌ Error en generación de variación: {e}")
+        log(f"❌ Error en generación de variación: {e}", logging.ERROR)
         raise
 
 
+def _load_mono(path):
+    """Lee una pista como float32 mono a SAMPLE_RATE."""
+    import soundfile as sf
+    y, sr = sf.read(path, dtype="float32", always_2d=True)
+    y = y.mean(axis=1)
+    # Solo se remuestrea si hace falta (los stems de Demucs vienen a 44.1 kHz)
+    if sr != SAMPLE_RATE:
+        try:
+            import soxr
+            y = soxr.resample(y, sr, SAMPLE_RATE, quality="HQ")
+        except ImportError:
+            import librosa
+            y = librosa.resample(y, orig_sr=sr, target_sr=SAMPLE_RATE)
+    return y
+
+
 def mix_tracks(track_paths: List[str], out_path: str):
     """
     Mezcla N pistas de audio.
     Normaliza la mezcla final para evitar clipping.
     """
-    import librosa
     import numpy as np
     
     log(f"Mezclando {len(track_paths)} pistas...")
@@ -258,28 +577,26 @@ def mix_tracks(track_paths: List[str], out_path: str):
         raise ValueError("No se proporcionaron pistas para mezclar")
 
     try:
-        loaded_audios = []
-        min_len = None
-
-        # 1. Cargar todos los audios
-        for path in track_paths:
-            y, _ = librosa.load(path, sr=SAMPLE_RATE, mono=True)
-            loaded_audios.append(y)
-            if min_len is None or len(y) < min_len:
-                min_len = len(y)
+        # 1. Cargar todos los audios en paralelo
+        #    (libsndfile y el remuestreo liberan el GIL mientras decodifican)
+        with ThreadPoolExecutor(max_workers=min(len(track_paths), os.cpu_count() or 1)) as ex:
+            loaded_audios = list(ex.map(_load_mono, track_paths))
+        min_len = min(len(y) for y in loaded_audios)
 
         if min_len == 0:
             raise ValueError("Una de las pistas tiene longitud 0")
 
-        # 2. Sumar (recortando al más corto)
-        mix = np.zeros(min_len, dtype=np.float32)
-        for y in loaded_audios:
-            mix += y[:min_len]
+        # 2. Sumar (recortando al más corto) en una sola reducción de NumPy
+        #    sobre una matriz contigua (N pistas x min_len muestras)
+        buf = np.empty((len(loaded_audios), min_len), dtype=np.float32)
+        for i, y in enumerate(loaded_audios):
+            buf[i] = y[:min_len]
+        mix = buf.sum(axis=0, dtype=np.float32)
 
-        # 3. Normalizar
-        max_val = np.max(np.abs(mix))
+        # 3. Normalizar (in place)
+        max_val = np.abs(mix).max()
         if max_val > 0:
-            mix = mix / (max_val + 1e-9)
+            np.divide(mix, max_val + 1e-9, out=mix)
 
         # 4. Guardar
         save_audio(out_path, mix, SAMPLE_RATE)
@@ -287,5 +604,5 @@ def mix_tracks(track_paths: List[str], out_path: str):
         return out_path
 
     except Exception as e:
-        log(f"❌ Error en mezcla: {e}")
+        log(f"❌ Error en mezcla: {e}", logging.ERROR)
         raise
@@ -72,14 +72,15 @@ async function handleFileUpload(file) {
     // Render waveform
     renderWaveform(file, 'sourceWaveform');
 
-    // Upload to server
-    const formData = new FormData();
-    formData.append('file', file);
-
+    // Upload to server (raw body: the server streams it straight to disk)
     try {
         const response = await fetch('/upload', {
             method: 'POST',
-            body: formData
+            headers: {
+                'Content-Type': 'application/octet-stream',
+                'X-Filename': encodeURIComponent(file.name)
+            },
+            body: file
         });
 
         if (!response.ok) {
@@ -183,7 +184,7 @@ document.getElementById('separateBtn')?.addEventListener('click', async () => {
             body: JSON.stringify({ nombre: state.sourceFile.name })
         });
 
-        const data = await response.json();
+        const data = await resolveJob(response);
 
         if (data.pistas) {
             state.stems = Object.entries(data.pistas).map(([name, path]) => ({
@@ -204,6 +205,20 @@ document.getElementById('separateBtn')?.addEventListener('click', async () => {
     }
 });
 
+// Long jobs answer 202 + job_id: poll /trabajos/<id> until the result is ready
+async function resolveJob(response) {
+    let data = await response.json();
+    const jobId = data.job_id;
+
+    while (response.status === 202 && jobId) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        response = await fetch(`/trabajos/${jobId}`);
+        data = await response.json();
+    }
+
+    return data;
+}
+
 function detectStemType(name) {
     const lower = name.toLowerCase();
     if (lower.includes('drum')) return 'drums';
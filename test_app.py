@@ -0,0 +1,175 @@
+"""
+Tests for the Flask routes: raw-body uploads and the background job API
+(/separar, /trabajos/<id>). Demucs is simulated.
+"""
+import unittest
+import importlib
+import io
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+
+class TestApp(unittest.TestCase):
+    _DUMMY_WAV = b"x" * 1024
+
+    @classmethod
+    def setUpClass(cls):
+        # app.py creates uploads/ and outputs_remix/ (and loads the saved state)
+        # relative to the working directory, so import it from a scratch dir
+        cls._tmp = tempfile.TemporaryDirectory(prefix="app_", dir=os.environ.get("PYTEST_TMPFS"))
+        cls._cwd = os.getcwd()
+        os.chdir(cls._tmp.name)
+        cls.app = importlib.import_module("app")
+        cls.client = cls.app.app.test_client()
+        # State persistence is not under test (and must not land in the repo)
+        cls._state_patcher = patch.object(cls.app.proyecto, "guardar_estado")
+        cls._state_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._state_patcher.stop()
+        os.chdir(cls._cwd)
+        cls._tmp.cleanup()
+
+    def _upload(self, name, content):
+        return self.client.post(
+            "/upload", data=content,
+            headers={"Content-Type": "application/octet-stream", "X-Filename": name},
+        )
+
+    def _leftover_temp_files(self):
+        return [n for n in os.listdir("uploads") if n.startswith(".upload-")]
+
+    def _fake_separation(self, release=None, error=None):
+        """separate_stems stand-in: optionally waits for `release`, then writes 4 stems."""
+        calls = []
+
+        def separate(ruta_archivo, out_dir, file_hash):
+            calls.append(ruta_archivo)
+            if release is not None:
+                release.wait(5)
+            if error is not None:
+                raise error
+            folder = Path(out_dir) / "stems" / file_hash
+            folder.mkdir(parents=True, exist_ok=True)
+            stems = {}
+            for name in ("vocals", "drums", "bass", "other"):
+                (folder / f"{name}.wav").write_bytes(self._DUMMY_WAV)
+                stems[name] = str(folder / f"{name}.wav")
+            return stems
+
+        return separate, calls
+
+    def _wait_until_finished(self, job_id):
+        self.app.TRABAJOS[job_id].result(timeout=5)
+        # The done-callback runs right after the result is set
+        deadline = time.monotonic() + 5
+        while job_id not in self.app._TRABAJOS_TERMINADOS and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    # ---------- /upload ----------
+
+    def test_raw_upload_registers_song(self):
+        response = self._upload("raw.mp3", b"r" * 5000)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["filename"], "raw.mp3")
+        self.assertEqual(Path("uploads/raw.mp3").read_bytes(), b"r" * 5000)
+        self.assertIsNotNone(self.app.proyecto.encontrar_cancion_por_archivo("raw.mp3"))
+        self.assertEqual(self._leftover_temp_files(), [])
+
+    def test_truncated_raw_upload_keeps_existing_file(self):
+        self._upload("keep.mp3", b"k" * 5000)
+
+        # The client announces more bytes than it sends, then disconnects
+        response = self.client.post(
+            "/upload", input_stream=io.BytesIO(b"n" * 5000),
+            content_type="application/octet-stream", headers={"X-Filename": "keep.mp3"},
+            environ_overrides={"CONTENT_LENGTH": "9000"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Path("uploads/keep.mp3").read_bytes(), b"k" * 5000)
+        self.assertEqual(self._leftover_temp_files(), [])
+
+    def test_duplicate_upload_does_not_touch_a_file_with_its_name(self):
+        self._upload("first.mp3", b"f" * 5000)
+        self._upload("taken.mp3", b"t" * 5000)
+
+        # taken.mp3 re-uploaded with first.mp3's content: recognised as first.mp3
+        response = self._upload("taken.mp3", b"f" * 5000)
+
+        self.assertEqual(response.get_json()["filename"], "first.mp3")
+        self.assertTrue(response.get_json()["reconocido"])
+        self.assertEqual(Path("uploads/taken.mp3").read_bytes(), b"t" * 5000)
+        self.assertEqual(self._leftover_temp_files(), [])
+
+    # ---------- job API ----------
+
+    def test_unknown_job_is_404(self):
+        self.assertEqual(self.client.get("/trabajos/nope").status_code, 404)
+
+    def test_concurrent_separations_share_one_job(self):
+        self._upload("shared.mp3", b"s" * 5000)
+        release = threading.Event()
+        separate, calls = self._fake_separation(release)
+
+        with patch.object(self.app, "separate_stems", separate):
+            first = self.client.post("/separar", json={"nombre": "shared.mp3"})
+            second = self.client.post("/separar", json={"nombre": "shared.mp3"})
+
+            self.assertEqual((first.status_code, second.status_code), (202, 202))
+            job_id = first.get_json()["job_id"]
+            self.assertEqual(second.get_json()["job_id"], job_id)
+            self.assertEqual(self.client.get(f"/trabajos/{job_id}").status_code, 202)
+
+            release.set()
+            self._wait_until_finished(job_id)
+
+        self.assertEqual(len(calls), 1)
+        # Every client sharing the job can collect the result
+        for _ in range(2):
+            response = self.client.get(f"/trabajos/{job_id}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.get_json()["pistas"]), {"vocals", "drums", "bass", "other"})
+
+        # Once finished, the stems are served from the cache without a new job
+        cached = self.client.post("/separar", json={"nombre": "shared.mp3"})
+        self.assertEqual(cached.status_code, 200)
+
+    def test_failed_job_is_500(self):
+        self._upload("broken.mp3", b"b" * 5000)
+        separate, _ = self._fake_separation(error=RuntimeError("Demucs falló"))
+
+        with patch.object(self.app, "separate_stems", separate):
+            job_id = self.client.post("/separar", json={"nombre": "broken.mp3"}).get_json()["job_id"]
+            with self.assertRaises(RuntimeError):
+                self.app.TRABAJOS[job_id].result(timeout=5)
+
+        response = self.client.get(f"/trabajos/{job_id}")
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("Demucs falló", response.get_json()["error"])
+
+    def test_finished_jobs_expire_after_ttl(self):
+        self._upload("ttl.mp3", b"l" * 5000)
+        separate, _ = self._fake_separation()
+
+        with patch.object(self.app, "separate_stems", separate):
+            job_id = self.client.post("/separar", json={"nombre": "ttl.mp3"}).get_json()["job_id"]
+            self._wait_until_finished(job_id)
+
+        self.assertEqual(self.client.get(f"/trabajos/{job_id}").status_code, 200)
+
+        # Age the job past the TTL: the next poll purges it
+        self.app._TRABAJOS_TERMINADOS[job_id] -= self.app.TRABAJO_TTL_SEG + 1
+        self.assertEqual(self.client.get(f"/trabajos/{job_id}").status_code, 404)
+        self.assertNotIn(job_id, self.app.TRABAJOS)
+        self.assertNotIn(job_id, self.app._TRABAJOS_TERMINADOS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for ProyectoAudio.encontrar_duplicado (size -> partial hash -> full hash cascade).
+"""
+import unittest
+import os
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+import clases
+from clases import Cancion, ProyectoAudio
+from procesamiento_audio import compute_file_hash, PARTIAL_HASH_SIZE, HASH_PREFIX
+
+
+class TestEncontrarDuplicado(unittest.TestCase):
+    # Same size and same first PARTIAL_HASH_SIZE bytes: only the full hash tells them apart
+    _CONTENT_A = b"a" * PARTIAL_HASH_SIZE + b"tail-a" * 100
+    _CONTENT_B = b"a" * PARTIAL_HASH_SIZE + b"tail-b" * 100
+
+    def setUp(self):
+        # ProyectoAudio creates outputs_remix/ in the working directory
+        self._tmp = tempfile.TemporaryDirectory(prefix="dup_", dir=os.environ.get("PYTEST_TMPFS"))
+        self.addCleanup(self._tmp.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self._tmp.name)
+
+        self.uploads = Path("uploads")
+        self.uploads.mkdir()
+        self.proyecto = ProyectoAudio("test")
+
+    def _upload(self, name, content, register=True, known_hash=False):
+        path = self.uploads / name
+        path.write_bytes(content)
+        if not register:
+            return str(path), None
+        cancion = Cancion(name, str(path))
+        if known_hash:
+            cancion.hash_archivo = compute_file_hash(str(path))
+        self.proyecto.agregar_cancion(cancion)
+        return str(path), cancion
+
+    def test_same_name_overwrite_with_new_content_is_not_duplicate(self):
+        path, _ = self._upload("song.mp3", self._CONTENT_A, known_hash=True)
+
+        # Re-upload under the same name: the old file is overwritten on disk
+        Path(path).write_bytes(self._CONTENT_B)
+
+        for file_hash in (None, compute_file_hash(path)):
+            with self.subTest(file_hash=file_hash):
+                existente, calculado = self.proyecto.encontrar_duplicado(path, file_hash)
+                self.assertIsNone(existente)
+                self.assertEqual(calculado, compute_file_hash(path))
+
+    def test_same_name_overwrite_with_same_content_is_duplicate(self):
+        path, cancion = self._upload("song.mp3", self._CONTENT_A, known_hash=True)
+
+        Path(path).write_bytes(self._CONTENT_A)
+
+        existente, _ = self.proyecto.encontrar_duplicado(path)
+        self.assertIs(existente, cancion)
+
+    def test_renamed_identical_file_is_duplicate(self):
+        _, cancion = self._upload("song.mp3", self._CONTENT_A)
+        path, _ = self._upload("renamed.wav", self._CONTENT_A, register=False)
+
+        existente, calculado = self.proyecto.encontrar_duplicado(path)
+
+        self.assertIs(existente, cancion)
+        self.assertEqual(calculado, compute_file_hash(path))
+        # The candidate's hash was computed lazily and indexed
+        self.assertIs(self.proyecto.encontrar_cancion_por_hash(calculado), cancion)
+
+    def test_same_size_different_content_is_not_duplicate(self):
+        self._upload("song.mp3", self._CONTENT_A)
+        path, _ = self._upload("other.mp3", self._CONTENT_B, register=False)
+
+        existente, calculado = self.proyecto.encontrar_duplicado(path)
+
+        self.assertIsNone(existente)
+        self.assertEqual(calculado, compute_file_hash(path))
+
+    def test_different_size_reads_nothing(self):
+        self._upload("song.mp3", self._CONTENT_A)
+        path, _ = self._upload("short.mp3", b"x" * 10, register=False)
+
+        with patch.object(clases, "compute_partial_hash") as partial, \
+                patch.object(clases, "compute_file_hash") as full:
+            existente, calculado = self.proyecto.encontrar_duplicado(path)
+
+        self.assertEqual((existente, calculado), (None, None))
+        partial.assert_not_called()
+        full.assert_not_called()
+
+
+    def test_hash_from_another_algorithm_is_dropped_on_load(self):
+        path, _ = self._upload("song.mp3", self._CONTENT_A, register=False)
+        current = compute_file_hash(path)
+        foreign = "other-" + current[len(HASH_PREFIX):]
+
+        for stored, expected in ((current, current), (foreign, None)):
+            with self.subTest(stored=stored):
+                cancion = Cancion.from_dict({"titulo": "song.mp3", "archivo_ruta": path, "hash_archivo": stored})
+                self.assertEqual(cancion.hash_archivo, expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,105 +1,200 @@
-import sys
-from unittest.mock import MagicMock
-
-# MOCK EVERYTHING that causes import errors
-sys.modules["modelos"] = MagicMock()
-sys.modules["torch"] = MagicMock()
-sys.modules["librosa"] = MagicMock()
-sys.modules["soundfile"] = MagicMock()
-sys.modules["demucs"] = MagicMock()
-sys.modules["demucs.apply"] = MagicMock()
-
-# Configure mocks to return iterable values where expected
-mock_modelos = sys.modules["modelos"]
-mock_modelos.get_musicgen.return_value = (MagicMock(), MagicMock())
+"""
+Tests for procesamiento_audio.separate_stems (Demucs is simulated).
 
+Set PYTEST_TMPFS to a RAM-backed directory (e.g. PYTEST_TMPFS=/dev/shm) to
+create the scratch files there instead of the default temp filesystem.
+"""
 import unittest
 import os
+import sys
 import shutil
 import tempfile
-from unittest.mock import patch, MagicMock
-from procesamiento_audio import separate_stems
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+import procesamiento_audio as pa
+from procesamiento_audio import (
+    separate_stems,
+    DemucsSubprocessError,
+    DemucsMissingOutputError,
+    DemucsEmptyStemsError,
+)
+
+class PopenStub:
+    """Minimal stand-in for subprocess.Popen: separate_stems only calls communicate()."""
+    __slots__ = ("returncode", "_out", "_err")
+
+    def __init__(self, out="", err="", rc=0):
+        self.returncode = rc
+        self._out = out
+        self._err = err
+
+    def communicate(self):
+        return (self._out, self._err)
+
+
+_SUCCESS = PopenStub("Demucs output", "", 0)
+_FAILURE = PopenStub("", "Error executing demucs", 1)
+
 
 class TestSeparateStems(unittest.TestCase):
+    # Built once: 1 KiB is just above separate_stems' 1000-byte "empty stem" threshold
+    _DUMMY_WAV = b"x" * 1024
+    _STEMS = ("vocals", "drums", "bass", "other")
+
+    @classmethod
+    def setUpClass(cls):
+        # Patched once for the whole class; each test configures the shared mock
+        cls._popen_patcher = patch.object(pa.subprocess, "Popen")
+        cls.mock_popen = cls._popen_patcher.start()
+        # These tests exercise the Demucs CLI backend (subprocess.Popen)
+        cls._backend_patcher = patch.object(pa, "DEMUCS_BACKEND", "cli")
+        cls._backend_patcher.start()
+
+        # The input is only read (Demucs is mocked): create it once for all tests
+        cls._class_tmp = tempfile.TemporaryDirectory(prefix="stems_", dir=os.environ.get("PYTEST_TMPFS"))
+        cls.input_file = Path(cls._class_tmp.name) / "test_song.mp3"
+        cls.input_file.write_text("dummy audio content")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._class_tmp.cleanup()
+        cls._backend_patcher.stop()
+        cls._popen_patcher.stop()
+
     def setUp(self):
-        # Create a temporary directory for inputs and outputs
-        self.test_dir = tempfile.mkdtemp()
-        self.input_file = os.path.join(self.test_dir, "test_song.mp3")
-        self.output_dir = os.path.join(self.test_dir, "outputs")
-        
-        # Create a dummy input file
-        with open(self.input_file, "w") as f:
-            f.write("dummy audio content")
+        self.mock_popen.reset_mock(return_value=True, side_effect=True)
+
+        # Fresh per-test directory for outputs, inside the class one
+        self._tmp = tempfile.TemporaryDirectory(dir=self._class_tmp.name)
+        self.test_dir = Path(self._tmp.name)
+        self.output_dir = self.test_dir / "outputs"
 
     def tearDown(self):
         # Clean up temporary directory
-        shutil.rmtree(self.test_dir)
-
-    @patch("procesamiento_audio.subprocess.Popen")
-    def test_separate_stems_success(self, mock_popen):
-        # 1. Setup Mock for subprocess
-        process_mock = MagicMock()
-        process_mock.communicate.return_value = ("Demucs output", "")
-        process_mock.returncode = 0
-        mock_popen.return_value = process_mock
-
-        # 2. Pre-create expected output files (simulating Demucs behavior)
-        # separate_stems expects: out_dir/htdemucs/test_song/{stems}.wav
-        song_name = "test_song"
-        demucs_out = os.path.join(self.output_dir, "htdemucs", song_name)
-        os.makedirs(demucs_out, exist_ok=True)
-        
-        expected_stems = ["vocals", "drums", "bass", "other"]
-        for stem in expected_stems:
-            stem_path = os.path.join(demucs_out, f"{stem}.wav")
-            with open(stem_path, "wb") as f:
-                f.write(b"dummy wav content" * 100) # Make sure size > 1000 bytes as per check
+        self._tmp.cleanup()
 
-        # 3. Call the function
-        result = separate_stems(self.input_file, self.output_dir)
+    def _create_demucs_output(self, output_dir, payload=None, stems=None):
+        # separate_stems expects: <-o folder>/htdemucs/test_song/{stems}.wav
+        demucs_out = output_dir / "htdemucs" / "test_song"
+        demucs_out.mkdir(parents=True, exist_ok=True)
+        # Write the payload once and hardlink it under every stem name
+        seed = demucs_out / ".seed"
+        seed.write_bytes(self._DUMMY_WAV if payload is None else payload)
+        for stem in stems or self._STEMS:
+            target = demucs_out / f"{stem}.wav"
+            try:
+                os.link(seed, target)
+            except OSError:
+                shutil.copyfile(seed, target)
+        seed.unlink()
 
-        # 4. Assertions
+    def _fake_demucs(self, payload=None, stems=None):
+        """Popen side effect: writes the stems into the `-o` folder, like Demucs."""
+        def popen(command, **kwargs):
+            self._create_demucs_output(Path(command[command.index("-o") + 1]), payload, stems)
+            return _SUCCESS
+        return popen
+
+    def test_separate_stems_success(self):
+        # 1. Setup Mock for subprocess (simulating Demucs writing its output)
+        self.mock_popen.side_effect = self._fake_demucs()
+
+        # 2. Call the function
+        result = separate_stems(str(self.input_file), str(self.output_dir))
+
+        # 3. Assertions
         self.assertEqual(len(result), 4)
         self.assertIn("vocals", result)
-        self.assertTrue(os.path.exists(result["vocals"]))
+        self.assertTrue(Path(result["vocals"]).exists())
         
         # Verify subprocess was called correctly
-        mock_popen.assert_called_once()
-        args, _ = mock_popen.call_args
+        self.mock_popen.assert_called_once()
+        args, _ = self.mock_popen.call_args
         command_list = args[0]
         self.assertEqual(command_list[0], "demucs")
         self.assertEqual(command_list[2], "htdemucs")
-        self.assertEqual(command_list[4], self.output_dir)
-        self.assertEqual(command_list[5], self.input_file)
-
-    @patch("procesamiento_audio.subprocess.Popen")
-    def test_separate_stems_subprocess_error(self, mock_popen):
-        # Setup Mock to fail
-        process_mock = MagicMock()
-        process_mock.communicate.return_value = ("", "Error executing demucs")
-        process_mock.returncode = 1
-        mock_popen.return_value = process_mock
-
-        # Assert RuntimeError is raised
-        with self.assertRaises(RuntimeError) as cm:
-            separate_stems(self.input_file, self.output_dir)
-        
-        self.assertIn("Demucs falló", str(cm.exception))
-
-    @patch("procesamiento_audio.subprocess.Popen")
-    def test_separate_stems_missing_output(self, mock_popen):
-        # Setup Mock to succeed but DON'T create files
-        process_mock = MagicMock()
-        process_mock.communicate.return_value = ("Done", "")
-        process_mock.returncode = 0
-        mock_popen.return_value = process_mock
-
-        # Assert RuntimeError (or specific error about missing files)
-        with self.assertRaises(RuntimeError) as cm:
-            separate_stems(self.input_file, self.output_dir)
-        
-        # The function checks for the folder first
-        self.assertTrue("no generó la carpeta" in str(cm.exception) or "stems salieron vacíos" in str(cm.exception))
+        # Demucs writes into a per-call scratch folder under stems/, removed afterwards
+        scratch = Path(command_list[4])
+        self.assertEqual(scratch.parent, self.output_dir / "stems")
+        self.assertFalse(scratch.exists())
+        self.assertEqual(command_list[5], str(self.input_file))
+
+    def test_separate_stems_vocals_only(self):
+        # --two-stems vocals writes vocals.wav and no_vocals.wav
+        self.mock_popen.side_effect = self._fake_demucs(stems=("vocals", "no_vocals"))
+
+        result = separate_stems(str(self.input_file), str(self.output_dir), stems="vocals")
+
+        self.assertEqual(list(result), ["vocals"])
+        command_list = self.mock_popen.call_args[0][0]
+        flag = command_list.index("--two-stems")
+        self.assertEqual(command_list[flag + 1], "vocals")
+        # The scratch folder is removed along with the unused no_vocals.wav
+        self.assertFalse(Path(command_list[command_list.index("-o") + 1]).exists())
+
+    def test_separate_stems_reuses_cached_stems(self):
+        self.mock_popen.side_effect = self._fake_demucs()
+
+        first = separate_stems(str(self.input_file), str(self.output_dir))
+        second = separate_stems(str(self.input_file), str(self.output_dir))
+
+        # Same content: the second call is served from the hash-keyed cache
+        self.assertEqual(first, second)
+        self.mock_popen.assert_called_once()
+
+    def test_separate_stems_inproc_backend(self):
+        # Fake torch/demucs stack: the resident model separates into 4 sources
+        model = MagicMock(sources=["drums", "bass", "other", "vocals"], samplerate=44100, audio_channels=2)
+        sources = MagicMock()
+        sources.__mul__.return_value = sources
+        sources.__add__.return_value = sources
+        sources.cpu.return_value = sources
+        sources.__iter__.side_effect = lambda: iter([MagicMock() for _ in model.sources])
+
+        modules = {name: MagicMock() for name in (
+            "torch", "soundfile", "demucs", "demucs.apply", "demucs.audio", "modelos",
+        )}
+        modules["modelos"].get_demucs_model.return_value = model
+        modules["demucs.apply"].apply_model.return_value = [sources]
+        prevent_clip = modules["demucs.audio"].prevent_clip
+        prevent_clip.side_effect = lambda wav, mode: wav
+        sf_write = modules["soundfile"].write
+        sf_write.side_effect = lambda path, *args, **kwargs: Path(path).write_bytes(self._DUMMY_WAV)
+
+        with patch.dict(sys.modules, modules), patch.object(pa, "DEMUCS_BACKEND", "inproc"):
+            result = separate_stems(str(self.input_file), str(self.output_dir))
+
+        self.assertEqual(set(result), set(self._STEMS))
+        for path in result.values():
+            self.assertTrue(os.path.exists(path))
+        self.mock_popen.assert_not_called()
+        # Written like the CLI: clipping prevented by rescaling, 16-bit PCM
+        self.assertEqual(prevent_clip.call_count, len(self._STEMS))
+        for call in prevent_clip.call_args_list:
+            self.assertEqual(call.kwargs["mode"], "rescale")
+        for call in sf_write.call_args_list:
+            self.assertEqual(call.args[2], 44100)
+            self.assertEqual(call.kwargs["subtype"], "PCM_16")
+
+    def test_separate_stems_failures(self):
+        # (Demucs process, stem payload it writes or None, expected error)
+        cases = (
+            (_FAILURE, None, DemucsSubprocessError),
+            (_SUCCESS, None, DemucsMissingOutputError),
+            (_SUCCESS, b"", DemucsEmptyStemsError),
+        )
+        for process, payload, error in cases:
+            with self.subTest(error=error.__name__):
+                self.mock_popen.reset_mock(return_value=True, side_effect=True)
+                self.mock_popen.return_value = process
+                if payload is not None:
+                    self.mock_popen.side_effect = self._fake_demucs(payload)
+                output_dir = Path(tempfile.mkdtemp(dir=self.test_dir))
+
+                with self.assertRaises(error):
+                    separate_stems(str(self.input_file), str(output_dir))
+                # No scratch folder is left behind on failure
+                self.assertEqual(list((output_dir / "stems").iterdir()), [])
 
 if __name__ == "__main__":
     unittest.main()